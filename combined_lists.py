@@ -1,14 +1,22 @@
 # Imports
 import csv
 import datetime
+import functools
 import glob
+import gzip
+import hashlib
+import heapq
+import io
+import json
 import shutil
+import struct
 import time
 import traceback
-import zipfile
+import zlib
 from itertools import islice
 import os
 import tempfile
+from contextlib import contextmanager
 
 # Imports of configuration variables
 from global_config import *
@@ -16,23 +24,59 @@ from global_config import *
 # Constants
 GLOBAL_MAX_RANK = 1000000
 LIST_FILENAME_FORMAT = "{}.csv"
-from shared import ZIP_FILENAME_FORMAT
+SOURCE_LIST_EXTENSIONS = [".zst", ".gz", ""]  # Compressed variants of source lists, in order of preference
+from shared import ZIP_FILENAME_FORMAT, EXPORT_FILENAME_FORMATS, JOB_EVENTS_CHANNEL_FORMAT
+
+# Connections and heavy imports are set up lazily on first use, so that importing this module has no side effects
 
 # When using AWS services, set up retrieval and storage of lists for S3
-if USE_S3:
+@functools.lru_cache(maxsize=None)
+def get_s3_resource():
     import boto3
-    s3_resource = boto3.resource('s3', region_name="us-east-1")
-    toplists_archive_bucket = s3_resource.Bucket(name=TOPLISTS_ARCHIVE_S3_BUCKET)
-    from smart_open import smart_open
+    return boto3.resource('s3', region_name="us-east-1")
+
+def get_toplists_archive_bucket():
+    return get_s3_resource().Bucket(name=TOPLISTS_ARCHIVE_S3_BUCKET)
+
+def get_toplists_generated_list_bucket():
+    return get_s3_resource().Bucket(name=TOPLISTS_GENERATED_LIST_S3_BUCKET)
+
+def smart_open(*args, **kwargs):
+    """ Open S3 location for streaming reads/writes """
+    from smart_open import open as _smart_open
+    return _smart_open(*args, **kwargs)
 
 # List ID generation
-from hashids import Hashids
-hsh = Hashids(salt="tsr", min_length=4, alphabet="BCDFGHJKLMNPQRSTVWXYZ23456789")
+@functools.lru_cache(maxsize=None)
+def get_hashids():
+    from hashids import Hashids
+    return Hashids(salt="tsr", min_length=4, alphabet="BCDFGHJKLMNPQRSTVWXYZ23456789")
 
 # Mongo connection for storing configuration of generated lists
-from pymongo import MongoClient
-client = MongoClient(MONGO_URL)
-db = client["tranco"]
+@functools.lru_cache(maxsize=None)
+def get_mongo_client():
+    from pymongo import MongoClient
+    return MongoClient(MONGO_URL)
+
+def get_db():
+    return get_mongo_client()["tranco"]
+
+# Parsed source lists shared between (warm) workers on this machine
+@functools.lru_cache(maxsize=None)
+def get_source_list_cache():
+    if not SOURCE_CACHE_PATH:
+        return None
+    from source_cache import SourceListCache
+    return SourceListCache(SOURCE_CACHE_PATH, SOURCE_CACHE_BUDGET)
+
+def __getattr__(name):
+    """ Lazily created module attributes of previous versions """
+    lazy_attributes = {"s3_resource": get_s3_resource, "toplists_archive_bucket": get_toplists_archive_bucket,
+                       "toplists_generated_list_bucket": get_toplists_generated_list_bucket, "hsh": get_hashids,
+                       "client": get_mongo_client, "db": get_db, "source_list_cache": get_source_list_cache}
+    if name in lazy_attributes:
+        return lazy_attributes[name]()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def count_dict(dct, entry, value=1):
     """ Helper function for updating dictionaries """
@@ -49,14 +93,14 @@ def date_list(start_date, end_date):
 def _db_id_to_list_id(db_id):
     """ List number to hash """
     if db_id:
-        return hsh.encode(db_id)
+        return get_hashids().encode(db_id)
     else:
         return None
 
 def _list_id_to_db_id(list_id):
     """ Hash to list number """
     try:
-        return hsh.decode(list_id)[0]
+        return get_hashids().decode(list_id)[0]
     except:
         return None
 
@@ -72,7 +116,7 @@ def config_to_list_id(config, insert=True, skip_failed=False):
         query = {**config, "failed": {"$ne": True}}
     else:
         query = config
-    out = db["lists"].find_one(query)
+    out = get_db()["lists"].find_one(query)
     if out:
         db_id = int(out["_id"])
     else:
@@ -87,29 +131,52 @@ def list_id_to_config(list_id):
     """ Retrieve configuration of existing list based on hash """
     db_id = _list_id_to_db_id(list_id)
     if db_id:
-        return {**db["lists"].find_one({"_id": int(db_id)}), "list_id": list_id}
+        return {**get_db()["lists"].find_one({"_id": int(db_id)}), "list_id": list_id}
 
 def list_available(list_id):
     """ Check if list is available for download """
     db_id = _list_id_to_db_id(list_id)
     if not db_id:
         return False
-    doc = db["lists"].find_one({"_id": int(db_id)})
+    doc = get_db()["lists"].find_one({"_id": int(db_id)})
     return doc is not None and doc.get("finished", False) and not doc.get("failed", True)
 
 def get_next_db_key():
     """ Get next key from list configuration database (for a new list) """
-    counter_increase = db["counter"].find_one_and_update({"_id": "lists"}, {'$inc': {'count': 1}})
+    counter_increase = get_db()["counter"].find_one_and_update({"_id": "lists"}, {'$inc': {'count': 1}})
     return int(counter_increase["count"])
 
 def insert_config_in_db(config, db_id):
     """ Insert a new configuration into the database, with the given key """
-    db["lists"].insert_one({**config, "_id": db_id, "finished": False,
+    get_db()["lists"].insert_one({**config, "_id": db_id, "finished": False,
                             "creationDate": datetime.datetime.now().strftime("%Y-%m-%d"),
                             "creationTime": datetime.datetime.now().isoformat()})
 
+def get_list_content_hash(list_id):
+    """ Get hash of the contents of a generated list (None for lists stored under their list ID) """
+    db_id = _list_id_to_db_id(list_id)
+    if not db_id:
+        return None
+    doc = get_db()["lists"].find_one({"_id": int(db_id)}, {"contentHash": 1})
+    return doc.get("contentHash", None) if doc else None
+
+def get_blob_key(content_hash, filename_format=LIST_FILENAME_FORMAT):
+    """ Get location of list contents (or an export of them) relative to the directory/bucket, sharded on hash prefix """
+    return "blobs/{}/{}/{}".format(content_hash[:2], content_hash[2:4], filename_format.format(content_hash))
+
+def get_blob_fp(content_hash):
+    """ Get file location of list contents with the given hash (file-based archive) """
+    return os.path.join(NETAPP_STORAGE_PATH, "generated_lists/{}".format(get_blob_key(content_hash)))
+
+def get_blob_s3(content_hash):
+    """ Get file location of list contents with the given hash (AWS S3) """
+    return "s3://{}/{}".format(TOPLISTS_GENERATED_LIST_S3_BUCKET, get_blob_key(content_hash))
+
 def get_generated_list_fp(list_id):
     """ Get file location of existing list (file-based archive) """
+    content_hash = get_list_content_hash(list_id)
+    if content_hash:
+        return get_blob_fp(content_hash)
     return os.path.join(NETAPP_STORAGE_PATH, "generated_lists/{}".format(LIST_FILENAME_FORMAT.format(list_id)))
 
 def get_generated_zip_fp(list_id):
@@ -118,28 +185,77 @@ def get_generated_zip_fp(list_id):
 
 def get_generated_list_s3(list_id):
     """ Get file location of existing list (AWS S3) """
+    content_hash = get_list_content_hash(list_id)
+    if content_hash:
+        return get_blob_s3(content_hash)
     return "s3://{}/{}".format(TOPLISTS_GENERATED_LIST_S3_BUCKET, LIST_FILENAME_FORMAT.format(list_id))
 
 def get_generated_zip_s3(list_id):
     """ Get file location of existing zip (AWS S3) """
     return "s3://{}/{}".format(TOPLISTS_DAILY_LIST_S3_BUCKET, ZIP_FILENAME_FORMAT.format(list_id))
 
+def get_generated_export_key(list_id, export_format):
+    """ Get location of export of a list relative to the exports directory/prefix (shared by lists with identical contents) """
+    content_hash = get_list_content_hash(list_id)
+    if content_hash:
+        return get_blob_key(content_hash, EXPORT_FILENAME_FORMATS[export_format])
+    return EXPORT_FILENAME_FORMATS[export_format].format(list_id)
+
+def get_generated_export_fp(list_id, export_format):
+    """ Get file location of existing export of a list (file-based archive) """
+    return os.path.join(NETAPP_STORAGE_PATH, "generated_lists_export/{}".format(get_generated_export_key(list_id, export_format)))
+
+def get_generated_export_s3(list_id, export_format):
+    """ Get file location of existing export of a list (AWS S3) """
+    return "s3://{}/export/{}".format(TOPLISTS_GENERATED_LIST_S3_BUCKET, get_generated_export_key(list_id, export_format))
+
+def export_available(list_id, export_format):
+    """ Check if export of a list exists (possibly written for another list with identical contents) """
+    if USE_S3:
+        key = "export/{}".format(get_generated_export_key(list_id, export_format))
+        return any(obj.key == key for obj in get_toplists_generated_list_bucket().objects.filter(Prefix=key))
+    else:
+        return os.path.exists(get_generated_export_fp(list_id, export_format))
+
 def get_list_fp_for_day(provider, date, parts=False):
-    """ Get file location for source list (of one of the providers) """
+    """ Get file location for source list (of one of the providers), preferring compressed variants """
     date = date.strftime("%Y%m%d")
     if parts:
-        fp = next(glob.iglob(os.path.join(NETAPP_STORAGE_PATH, "archive/{}/parts/{}_{}_parts.csv".format(provider, provider, date))))
+        fp = os.path.join(NETAPP_STORAGE_PATH, "archive/{}/parts/{}_{}_parts.csv".format(provider, provider, date))
     else:
-        fp = next(glob.iglob(os.path.join(NETAPP_STORAGE_PATH, "archive/{}/{}_{}.csv".format(provider, provider, date))))
-    return fp
+        fp = os.path.join(NETAPP_STORAGE_PATH, "archive/{}/{}_{}.csv".format(provider, provider, date))
+    for extension in SOURCE_LIST_EXTENSIONS:
+        for match in glob.iglob(fp + extension):
+            return match
+    raise FileNotFoundError(fp)
+
+def list_s3_keys_for_month(provider, date, parts=False):
+    """ List keys of source lists (of one of the providers) for all days in the month of the given date """
+    month = date.strftime("%Y%m")
+    if parts:
+        prefix = "{}/parts/{}_{}".format(provider, provider, month)
+    else:
+        prefix = "{}/{}_{}".format(provider, provider, month)
+    return {obj.key for obj in get_toplists_archive_bucket().objects.filter(Prefix=prefix)}
 
-def get_s3_key_for_day(provider, date, parts=False):
-    """ Get S3 key for source list (of one of the providers) """
+def get_s3_key_for_day(provider, date, parts=False, available_keys=None):
+    """ Get S3 key for source list (of one of the providers), preferring compressed variants
+    :param available_keys: cache of listed keys per provider and month, to be reused for other days (one S3 LIST request per month instead of per day)
+    """
+    if available_keys is None:
+        available_keys = {}
+    month_key = (provider, date.strftime("%Y%m"), parts)
+    if month_key not in available_keys:
+        available_keys[month_key] = list_s3_keys_for_month(provider, date, parts)
+    available = available_keys[month_key]
     date = date.strftime("%Y%m%d")
     if parts:
         fp = "{}/parts/{}_{}_parts.csv".format(provider, provider, date)
     else:
         fp = "{}/{}_{}.csv".format(provider, provider, date)
+    for extension in SOURCE_LIST_EXTENSIONS:
+        if fp + extension in available:
+            return fp + extension
     return fp
 
 def get_s3_url_for_day(provider, date, parts=False):
@@ -151,23 +267,105 @@ def get_s3_url_for_fp(fp):
     """ Get S3 url for source list (of one of the providers) """
     return "s3://{}/{}".format(TOPLISTS_ARCHIVE_S3_BUCKET, fp)
 
-def generate_prefix_items_file(fp, list_prefix):
-    """ Create list of source list items (up to requested list length) """
-    with open(fp, encoding='utf8') as f:
+@contextmanager
+def decompressed_text(raw, fp):
+    """ Wrap a binary stream of a (potentially compressed) source list as a stream of text lines, decompressing on the fly """
+    if fp.endswith(".gz"):
+        stream = gzip.GzipFile(fileobj=raw)
+    elif fp.endswith(".zst"):
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+    else:
+        stream = raw
+    with io.TextIOWrapper(stream, encoding='utf8') as f:
+        yield f
+
+class LocalSourceList:
+    """ Source list given outside the archive: a local (optionally compressed) file, or rows in memory """
+    def __init__(self, source):
+        """
+
+        :param source: path of source list, or iterable of rows (rank, domain, or all columns of parts files)
+        """
+        if isinstance(source, (str, os.PathLike)):
+            self.source = source
+        else:
+            # Rows are read once per pass (scoring, then inclusion filters), so iterators are materialized
+            self.source = list(source)
+
+    @contextmanager
+    def open(self):
+        """ Open source list as text lines """
+        if isinstance(self.source, (str, os.PathLike)):
+            with open_source_list_file(os.fspath(self.source)) as f:
+                yield f
+        else:
+            yield (",".join(str(value) for value in row) for row in self.source)
+
+@contextmanager
+def open_source_list_file(fp):
+    """ Open source list as text (file-based archive or local source list) """
+    if isinstance(fp, LocalSourceList):
+        with fp.open() as f:
+            yield f
+    else:
+        with open(fp, 'rb') as raw:
+            with decompressed_text(raw, fp) as f:
+                yield f
+
+@contextmanager
+def open_source_list_s3(fp):
+    """ Open source list as text (AWS S3) """
+    with smart_open(get_s3_url_for_fp(fp), 'rb', compression='disable') as raw:
+        with decompressed_text(raw, fp) as f:
+            yield f
+
+def cached_prefix_items(fp, list_prefix, read_prefix_items):
+    """ Get source list items from the source list cache, reading (and caching) the source list if necessary """
+    source_list_cache = get_source_list_cache()
+    if source_list_cache is None or isinstance(fp, LocalSourceList):
+        return read_prefix_items(fp, list_prefix)
+    items = source_list_cache.get(fp, list_prefix)
+    if items is None:
+        items = read_prefix_items(fp, list_prefix)
+        try:
+            source_list_cache.put(fp, list_prefix, items)
+        except:
+            traceback.print_exc()
+    return items
+
+def read_prefix_items_file(fp, list_prefix):
+    """ Read source list items (up to requested list length) """
+    with open_source_list_file(fp) as f:
         if list_prefix:
-            return [r.split(",") for r in islice(f.read().splitlines(), list_prefix)]
+            return [r.rstrip("\r\n").split(",") for r in islice(f, list_prefix)]
         else:
-            return [r.split(",") for r in f.read().splitlines()]
+            return [r.rstrip("\r\n").split(",") for r in f]
 
-def generate_prefix_items_s3(fp, list_prefix):
-    """ Create list of source list items (up to requested list length) """
-    with smart_open(get_s3_url_for_fp(fp)) as f:
+def read_prefix_items_s3(fp, list_prefix):
+    """ Read source list items (up to requested list length) """
+    with open_source_list_s3(fp) as f:
         if list_prefix:
-            result = [r.decode("utf-8").split(",") for r in islice(f.read().splitlines(), list_prefix)]
+            result = [r.rstrip("\r\n").split(",") for r in islice(f, list_prefix)]
         else:
-            result = [r.decode("utf-8").split(",") for r in f.read().splitlines()]
+            result = [r.rstrip("\r\n").split(",") for r in f]
         return result
 
+def generate_prefix_items_file(fp, list_prefix):
+    """ Create list of source list items (up to requested list length) """
+    return cached_prefix_items(fp, list_prefix, read_prefix_items_file)
+
+def generate_prefix_items_s3(fp, list_prefix):
+    """ Create list of source list items (up to requested list length) """
+    return cached_prefix_items(fp, list_prefix, read_prefix_items_s3)
+
+def generate_prefix_items(fp, list_prefix):
+    """ Create list of source list items (up to requested list length), wherever the source list is stored """
+    if USE_S3 and not isinstance(fp, LocalSourceList):
+        return generate_prefix_items_s3(fp, list_prefix)
+    else:
+        return generate_prefix_items_file(fp, list_prefix)
+
 def rescale_rank(rank, max_rank_of_input, min_rank_of_output, max_rank_of_output):
     """
     Rescale a given rank to the min/max range provided
@@ -175,154 +373,260 @@ def rescale_rank(rank, max_rank_of_input, min_rank_of_output, max_rank_of_output
     """
     return min_rank_of_output + (rank - 1)*((max_rank_of_output-min_rank_of_output)/(max_rank_of_input - 1))
 
+def score_contribution(combination_method, rank, max_rank_of_input, max_rank_of_output):
+    """ Score of a domain at the given rank of one source list """
+    # Ranks are rescaled to make sure that shorter lists (i.e. Quantcast) are not given a higher importance
+    if combination_method == 'borda':
+        return max_rank_of_output + 1 - rescale_rank(int(rank), max_rank_of_input, 1, max_rank_of_output)
+    elif combination_method == 'dowdall':
+        return 1 / rescale_rank(int(rank), max_rank_of_input, 1, max_rank_of_output)
+    else:
+        raise Exception("Unknown combination method")
+
+def score_contributions(fps, input_prefix, config, parts_filter, combination_method, maintain_rank=True):
+    """ Generate the (domain, score) contributions of every source list (one generator per list), in aggregation order """
+    max_rank_of_output = min(GLOBAL_MAX_RANK, input_prefix if input_prefix else GLOBAL_MAX_RANK)
+    if parts_filter:
+        lists = ((filtered_lst, max_rank if maintain_rank else len(filtered_lst)) for (filtered_lst, max_rank) in get_filtered_parts_lists(fps, input_prefix, config))
+    else:
+        lists = ((items, len(items)) for items in (generate_prefix_items(fp, input_prefix) for fp in fps))
+    for items, max_rank_of_input in lists:
+        yield ((elem, score_contribution(combination_method, rank, max_rank_of_input, max_rank_of_output)) for rank, elem in items)
+
+def aggregate_scores(contributions):
+    """ Sum the score contributions of all source lists per domain """
+    scores = {}
+    for list_contributions in contributions:
+        for elem, value in list_contributions:
+            count_dict(scores, elem, value)
+    return scores
+
 def borda_count_fp(fps, list_prefix):
     """ Generate aggregate scores for domains based on Borda count """
-    borda_scores = {}
-    for fp in fps:
-        if USE_S3:
-            items = generate_prefix_items_s3(fp, list_prefix)
-        else:
-            items = generate_prefix_items_file(fp, list_prefix)
-        max_rank_of_input = len(items)
-        max_rank_of_output = min(GLOBAL_MAX_RANK, list_prefix if list_prefix else GLOBAL_MAX_RANK)
-        for rank, elem in items:
-            count_dict(borda_scores, elem, max_rank_of_output + 1 - rescale_rank(int(rank), max_rank_of_input, 1, max_rank_of_output))  # necessary to rescale shorter lists (i.e. Quantcast)
-    return borda_scores
+    return aggregate_scores(score_contributions(fps, list_prefix, None, False, 'borda'))
 
 def dowdall_count_fp(fps, list_prefix):
     """ Generate aggregate scores for domains based on Dowdall count """
-    dowdall_scores = {}
-    for fp in fps:
-        if USE_S3:
-            items = generate_prefix_items_s3(fp, list_prefix)
+    return aggregate_scores(score_contributions(fps, list_prefix, None, False, 'dowdall'))
+
+def filter_parts_items(parts_items, f_pld=None, f_tlds=None, f_organization=None, f_subdomains=None, maintain_rank=True):
+    """ Get list of domains that conform to the set filters, from items of a parts file """
+    output = []
+    organizations_seen = set()
+    new_rank = 1
+    max_rank = 0
+    for rank, fqdn, pld, sld, subd, ps, tld, is_pld in parts_items:
+        max_rank += 1
+        if f_tlds and (tld not in f_tlds):
+            continue
+        if f_subdomains and (subd not in f_subdomains):
+            continue
+        if f_organization:
+            if sld in organizations_seen:
+                continue
+            else:
+                organizations_seen.add(sld)
+        if f_pld:
+            if is_pld != "True":
+                continue
+        if maintain_rank:
+            output.append((rank, fqdn))
         else:
-            items = generate_prefix_items_file(fp, list_prefix)
-        max_rank_of_input = len(items)
-        max_rank_of_output = min(GLOBAL_MAX_RANK, list_prefix if list_prefix else GLOBAL_MAX_RANK)
-        for rank, elem in items:
-            count_dict(dowdall_scores, elem, 1 / rescale_rank(int(rank), max_rank_of_input, 1, max_rank_of_output))  # necessary to rescale shorter lists (i.e. Quantcast)
-    return dowdall_scores
+            output.append((new_rank, fqdn))
+            new_rank += 1
+    return (output, max_rank)
 
 def filtered_parts_list_file(fp, list_prefix, f_pld=None, f_tlds=None, f_organization=None, f_subdomains=None, maintain_rank=True):
     """ Get list of domains that conform to the set filters """
-    with open(fp) as f:
-        if list_prefix:
-            parts_input = islice(f, list_prefix)
-        else:
-            parts_input = f
-        output = []
-        organizations_seen = set()
-        new_rank = 1
-        max_rank = 0
-        for line in parts_input:
-            max_rank += 1
-            rank, fqdn, pld, sld, subd, ps, tld, is_pld = line.rstrip().split(",")
-            if f_tlds and (tld not in f_tlds):
-                continue
-            if f_subdomains and (subd not in f_subdomains):
-                continue
-            if f_organization:
-                if sld in organizations_seen:
-                    continue
-                else:
-                    organizations_seen.add(sld)
-            if f_pld:
-                if is_pld != "True":
-                    continue
-            if maintain_rank:
-                output.append((rank, fqdn))
-            else:
-                output.append((new_rank, fqdn))
-                new_rank += 1
-    return (output, max_rank)
+    return filter_parts_items(generate_prefix_items_file(fp, list_prefix), f_pld, f_tlds, f_organization, f_subdomains, maintain_rank)
 
 def filtered_parts_list_s3(fp, list_prefix, f_pld=None, f_tlds=None, f_organization=None, f_subdomains=None, maintain_rank=True):
     """ Get list of domains that conform to the set filters """
-    with smart_open(get_s3_url_for_fp(fp)) as f:
-        if list_prefix:
-            parts_input = islice(f, list_prefix)
-        else:
-            parts_input = f
-        output = []
-        organizations_seen = set()
-        new_rank = 1
-        max_rank = 0
-        for line in parts_input:
-            max_rank += 1
-            rank, fqdn, pld, sld, subd, ps, tld, is_pld = line.decode("utf-8").rstrip().split(",")
-            if f_tlds and (tld not in f_tlds):
-                continue
-            if f_subdomains and (subd not in f_subdomains):
-                continue
-            if f_organization:
-                if sld in organizations_seen:
-                    continue
-                else:
-                    organizations_seen.add(sld)
-            if f_pld:
-                if is_pld != "True":
-                    continue
-            if maintain_rank:
-                output.append((rank, fqdn))
-            else:
-                output.append((new_rank, fqdn))
-                new_rank += 1
-    return (output, max_rank)
+    return filter_parts_items(generate_prefix_items_s3(fp, list_prefix), f_pld, f_tlds, f_organization, f_subdomains, maintain_rank)
 
 def get_filtered_parts_lists(fps, input_prefix, config, maintain_rank=True):
     """ Get domains in given source lists that conform to the filters in the configuration """
     for fp in fps:
-        if USE_S3:
-            yield filtered_parts_list_s3(fp, input_prefix,
-                                          config.get("filterPLD", None) == "on",
-                                          config.get('filterTLDValue').split(",") if config.get("filterTLDValue",
-                                                                                                None) else None,
-                                          config.get("filterOrganization", None) == "on",
-                                          config.get('filterSubdomainValue').split(",") if config.get(
-                                              "filterSubdomainValue", None) else None,
-                                         maintain_rank=maintain_rank
-                                          )
+        if USE_S3 and not isinstance(fp, LocalSourceList):
+            filtered_parts_list = filtered_parts_list_s3
         else:
-            yield filtered_parts_list_file(fp, input_prefix,
-                                         config.get("filterPLD", None) == "on",
-                                         config.get('filterTLDValue').split(",") if config.get("filterTLDValue",
-                                                                                               None) else None,
-                                         config.get("filterOrganization", None) == "on",
-                                         config.get('filterSubdomainValue').split(",") if config.get(
-                                             "filterSubdomainValue", None) else None,
-                                           maintain_rank=maintain_rank
-                                         )
+            filtered_parts_list = filtered_parts_list_file
+        yield filtered_parts_list(fp, input_prefix,
+                                  config.get("filterPLD", None) == "on",
+                                  config.get('filterTLDValue').split(",") if config.get("filterTLDValue",
+                                                                                        None) else None,
+                                  config.get("filterOrganization", None) == "on",
+                                  config.get('filterSubdomainValue').split(",") if config.get(
+                                      "filterSubdomainValue", None) else None,
+                                  maintain_rank=maintain_rank
+                                  )
 
 def borda_count_list(fps, input_prefix, config, maintain_rank=True):
     """ Generate aggregate scores for list of filtered domains based on Borda count """
-    borda_scores = {}
-    for (filtered_lst, max_rank) in get_filtered_parts_lists(fps, input_prefix, config):
-        if maintain_rank:
-            max_rank_of_input = max_rank
-        else:
-            max_rank_of_input = len(filtered_lst)
-        max_rank_of_output = min(GLOBAL_MAX_RANK, input_prefix if input_prefix else GLOBAL_MAX_RANK)
-        for rank, elem in filtered_lst:
-            count_dict(borda_scores, elem, max_rank_of_output + 1 - rescale_rank(int(rank), max_rank_of_input, 1, max_rank_of_output))  # necessary to rescale shorter lists
-    return borda_scores
+    return aggregate_scores(score_contributions(fps, input_prefix, config, True, 'borda', maintain_rank))
 
 def dowdall_count_list(fps, input_prefix, config, maintain_rank=True):
     """ Generate aggregate scores for list of filtered domains based on Dowdall count """
-    dowdall_scores = {}
-    for (filtered_lst, max_rank) in get_filtered_parts_lists(fps, input_prefix, config):
-        if maintain_rank:
-            max_rank_of_input = max_rank
-        else:
-            max_rank_of_input = len(filtered_lst)
-        max_rank_of_output = min(GLOBAL_MAX_RANK, input_prefix if input_prefix else GLOBAL_MAX_RANK)
-        for rank, elem in filtered_lst:
-            count_dict(dowdall_scores, elem, 1 / rescale_rank(int(rank), max_rank_of_input, 1, max_rank_of_output))  # necessary to rescale shorter lists
-    return dowdall_scores
+    return aggregate_scores(score_contributions(fps, input_prefix, config, True, 'dowdall', maintain_rank))
 
 def sort_counts(scores):
     """ Sort domains based on aggregate scores """
     return sorted(scores.keys(), key=lambda elem: (-scores[elem], elem))
 
+def domain_partition(elem, nb_partitions):
+    """ Assign domain to a partition (stable across processes, unlike hash()) """
+    return zlib.crc32(elem.encode("utf8")) % nb_partitions
+
+def write_partition_record(f, elem, values):
+    """ Write binary record of a domain with a sequence of scores """
+    encoded = elem.encode("utf8")
+    f.write(struct.pack("<HI", len(encoded), len(values)))
+    f.write(encoded)
+    f.write(struct.pack("<{}d".format(len(values)), *values))
+
+def read_partition_records(f):
+    """ Read binary records of domains with a sequence of scores """
+    header_size = struct.calcsize("<HI")
+    while True:
+        header = f.read(header_size)
+        if not header:
+            break
+        elem_length, nb_values = struct.unpack("<HI", header)
+        elem = f.read(elem_length).decode("utf8")
+        values = struct.unpack("<{}d".format(nb_values), f.read(8 * nb_values))
+        yield elem, values
+
+def write_presence_record(f, elem, filter_idx, group_idx):
+    """ Write binary record of the presence of a domain in a group of source lists of a presence filter """
+    encoded = elem.encode("utf8")
+    f.write(struct.pack("<HHH", len(encoded), filter_idx, group_idx))
+    f.write(encoded)
+
+def read_presence_records(f):
+    """ Read binary records of the presence of domains in groups of source lists """
+    header_size = struct.calcsize("<HHH")
+    while True:
+        header = f.read(header_size)
+        if not header:
+            break
+        elem_length, filter_idx, group_idx = struct.unpack("<HHH", header)
+        yield f.read(elem_length).decode("utf8"), filter_idx, group_idx
+
+def presence_contributions(groups_of_fps, prefix):
+    """ Generate the domains of every source list (one generator per list), with the index of the group of the list """
+    for group_idx, group in enumerate(groups_of_fps):
+        for fp in group:
+            yield group_idx, (item[1] for item in generate_prefix_items(fp, prefix))
+
+def reduce_partition(partition_fp, sorted_partition_fp, presence_fp=None, minimums=()):
+    """
+    Aggregate the score contributions for the domains of one partition, and write them sorted on aggregate score
+    (keeping only domains that appear in the minimum number of groups for every presence filter)
+    """
+    scores = {}
+    with open(partition_fp, 'rb') as f:
+        for elem, values in read_partition_records(f):
+            for value in values:
+                count_dict(scores, elem, value)
+    if minimums:
+        presence = {}
+        with open(presence_fp, 'rb') as f:
+            for elem, filter_idx, group_idx in read_presence_records(f):
+                if elem in scores:
+                    presence.setdefault(elem, set()).add((filter_idx, group_idx))
+        def conforms(elem):
+            counts = [0] * len(minimums)
+            for filter_idx, _ in presence.get(elem, ()):
+                counts[filter_idx] += 1
+            return all(count >= minimum for count, minimum in zip(counts, minimums))
+        scores = {elem: score for elem, score in scores.items() if conforms(elem)}
+    with open(sorted_partition_fp, 'wb') as f:
+        for elem in sort_counts(scores):
+            write_partition_record(f, elem, (scores[elem],))
+
+def read_sorted_partition(sorted_partition_fp):
+    """ Read sorted partition as sort keys (negated score, domain) """
+    with open(sorted_partition_fp, 'rb') as f:
+        for elem, (value,) in read_partition_records(f):
+            yield -value, elem
+
+class PartitionedRanking:
+    """
+    Ranking of domains computed over hash partitions, bounding memory use by the size of one partition.
+    Score contributions (and presence in source lists, for presence filters) are split over partition files on disk,
+    each partition is aggregated, filtered and sorted independently (optionally in separate processes), and iterating
+    merges the sorted partitions into the same order as sort_counts.
+    """
+    def __init__(self, contributions, nb_partitions, processes=None, tmp_path=None, lists_per_group=1, presence_filters=()):
+        """
+
+        :param contributions: (domain, score) contributions of every source list (as from score_contributions)
+        :param nb_partitions: number of hash partitions
+        :param processes: number of processes for aggregating partitions (in this process if not set)
+        :param tmp_path: directory for partition files (default temporary directory if not set)
+        :param lists_per_group: number of source lists whose contributions are grouped per domain before writing to disk
+        :param presence_filters: (presence, minimum) for every filter that keeps only domains appearing in at least minimum
+                                 groups of source lists, with presence the domains of every source list with the index
+                                 of its group (as from presence_contributions)
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory(dir=tmp_path)  # removed when the ranking is garbage collected
+        partition_fps = [os.path.join(self.tmp_dir.name, "{}.bin".format(p)) for p in range(nb_partitions)]
+        presence_fps = [os.path.join(self.tmp_dir.name, "{}_presence.bin".format(p)) for p in range(nb_partitions)]
+        self.sorted_partition_fps = [os.path.join(self.tmp_dir.name, "{}_sorted.bin".format(p)) for p in range(nb_partitions)]
+        minimums = [minimum for _, minimum in presence_filters]
+
+        # Map: contributions of a group of source lists are combined per domain, so the domain is written once per group.
+        # The scores of a domain are kept as a sequence in aggregation order (not summed), so floating point sums in the
+        # reduce are identical to count_dict.
+        partition_files = [open(fp, 'wb') for fp in partition_fps]
+        try:
+            combined = {}
+            for idx, list_contributions in enumerate(contributions):
+                for elem, value in list_contributions:
+                    if elem in combined:
+                        combined[elem].append(value)
+                    else:
+                        combined[elem] = [value]
+                if (idx + 1) % lists_per_group == 0:
+                    self.write_combined(partition_files, combined)
+                    combined = {}
+            self.write_combined(partition_files, combined)
+        finally:
+            for f in partition_files:
+                f.close()
+        if presence_filters:
+            presence_files = [open(fp, 'wb') for fp in presence_fps]
+            try:
+                for filter_idx, (presence, _) in enumerate(presence_filters):
+                    for group_idx, elems in presence:
+                        for elem in elems:
+                            write_presence_record(presence_files[domain_partition(elem, nb_partitions)], elem, filter_idx, group_idx)
+            finally:
+                for f in presence_files:
+                    f.close()
+
+        # Reduce
+        if processes and processes > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                list(executor.map(reduce_partition, partition_fps, self.sorted_partition_fps, presence_fps, [minimums] * nb_partitions))
+        else:
+            for partition_fp, sorted_partition_fp, presence_fp in zip(partition_fps, self.sorted_partition_fps, presence_fps):
+                reduce_partition(partition_fp, sorted_partition_fp, presence_fp, minimums)
+        for fp in partition_fps + presence_fps:
+            if os.path.exists(fp):
+                os.remove(fp)
+
+    @staticmethod
+    def write_combined(partition_files, combined):
+        for elem, values in combined.items():
+            write_partition_record(partition_files[domain_partition(elem, len(partition_files))], elem, values)
+
+    def __iter__(self):
+        """ k-way merge of the sorted partitions """
+        for _, elem in heapq.merge(*[read_sorted_partition(fp) for fp in self.sorted_partition_fps]):
+            yield elem
+
 def filter_list_1(lst, filter_set, list_size=None):
     """ Filter list of domains on given set of domains """
     if list_size:
@@ -344,7 +648,7 @@ def count_presence_in_fps(fps, prefix):
     """ Counts of occurrences in given files with domains """
     presence = {}
     for fp in fps:
-        lst = generate_prefix_items_s3(fp, prefix)
+        lst = generate_prefix_items(fp, prefix)
         for i in lst:
             count_dict(presence, i, 1)
 
@@ -358,7 +662,7 @@ def count_presence_in_sets(sets,):
 
 def items_in_any_list(fps, prefix):
     """ Find domains that appear in any of the given lists """
-    return set.union(*map(set, [[i[1] for i in generate_prefix_items_s3(fp, prefix)] for fp in fps]))
+    return set.union(*map(set, [[i[1] for i in generate_prefix_items(fp, prefix)] for fp in fps]))
 
 def generate_filter_minimum_presence(fps, prefix, minimum):
     """ An item should appear on all the lists """
@@ -382,65 +686,54 @@ def write_sorted_counts(sorted_items, scores, fp):
         for idx, entry in enumerate(sorted_items):
             csvw.writerow([idx + 1, entry, scores[entry]])
 
-def write_list_to_file(lst, list_id):
-    """ Write ranks and domains to file """
-    with open(get_generated_list_fp(list_id), 'w', encoding='utf8') as f:
-        csvw = csv.writer(f)
-        for idx, entry in enumerate(lst):
-            csvw.writerow([idx + 1, entry])
-
-
-def write_zip_to_file(lst, list_id):
-    """ Write list of (top 1M) domains to zip file """
-    with tempfile.SpooledTemporaryFile(mode='w+b') as z:
-        with tempfile.NamedTemporaryFile(mode='w+') as t:
-            csvw = csv.writer(t)
-            for idx, entry in enumerate(lst):
-                csvw.writerow([idx + 1, entry])
-
-            t.seek(0)
+def list_csv_chunks(lst, chunk_size=10000):
+    """ Serialize ranks and domains as CSV, in chunks of lines """
+    buffer = io.StringIO()
+    csvw = csv.writer(buffer)
+    for idx, entry in enumerate(lst):
+        csvw.writerow([idx + 1, entry])
+        if (idx + 1) % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def list_content_hash(lst):
+    """ Hash of list contents as written to file """
+    h = hashlib.sha256()
+    for chunk in list_csv_chunks(lst):
+        h.update(chunk.encode("utf8"))
+    return h.hexdigest()
 
-            with zipfile.ZipFile(z, 'w') as a:
-                a.write(t.name, arcname="top-1m.csv")
-
-            z.seek(0)
-
-            with open(get_generated_zip_fp(list_id), 'wb') as f:
-                f.write(z.read())
+def write_list_to_file(lst, list_id):
+    """ Write ranks and domains to file, stored by content hash (write is skipped if identical contents exist already) """
+    content_hash = list_content_hash(lst)
+    fp = get_blob_fp(content_hash)
+    if not os.path.exists(fp):
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        tmp_fp = "{}.{}.tmp".format(fp, list_id)
+        with open(tmp_fp, 'w', encoding='utf8', newline='') as f:
+            for chunk in list_csv_chunks(lst):
+                f.write(chunk)
+        os.replace(tmp_fp, fp)  # atomic, also if a job with identical output finishes at the same time
+    return content_hash
 
 
 def write_list_to_s3(lst, list_id):
-    """ Write ranks and domains to file """
-    with smart_open(get_generated_list_s3(list_id), 'w', encoding='utf8') as f:
-        csvw = csv.writer(f)
-        for idx, entry in enumerate(lst):
-            csvw.writerow([idx + 1, entry])
-
-
-def write_zip_to_s3(lst, list_id):
-    """ Write list of (top 1M) domains to zip file """
-    with tempfile.SpooledTemporaryFile(mode='w+b') as z:
-        with tempfile.NamedTemporaryFile(mode='w+') as t:
-            csvw = csv.writer(t)
-            for idx, entry in enumerate(lst):
-                csvw.writerow([idx + 1, entry])
-
-            t.seek(0)
-
-            with zipfile.ZipFile(z, 'w') as a:
-                a.write(t.name, arcname="top-1m.csv")
-
-            z.seek(0)
-
-            with smart_open(get_generated_zip_s3(list_id), 'wb') as f:
-                f.write(z.read())
+    """ Write ranks and domains to file, stored by content hash (write is skipped if identical contents exist already) """
+    content_hash = list_content_hash(lst)
+    if not any(True for _ in get_toplists_generated_list_bucket().objects.filter(Prefix=get_blob_key(content_hash))):
+        with smart_open(get_blob_s3(content_hash), 'w', encoding='utf8', newline='') as f:
+            for chunk in list_csv_chunks(lst):
+                f.write(chunk)
+    return content_hash
 
 
 def copy_daily_list_s3(list_id):
     """ Copy the daily list on S3 to the fixed URL """
     zip_key = ZIP_FILENAME_FORMAT.format(list_id)
     source = {'Bucket': TOPLISTS_DAILY_LIST_S3_BUCKET, 'Key': zip_key}
-    target_bucket = s3_resource.Bucket(TOPLISTS_DAILY_LIST_S3_BUCKET)
+    target_bucket = get_s3_resource().Bucket(TOPLISTS_DAILY_LIST_S3_BUCKET)
     target_bucket.copy(source, 'top-1m.csv.zip')
 
 
@@ -450,42 +743,82 @@ def copy_daily_list_file(list_id):
     target_file = os.path.join(NETAPP_STORAGE_PATH, "generated_lists_zip/{}".format("top-1m.csv.zip"))
     shutil.copy2(zip_file, target_file)
 
-def generate_combined_list(config, list_id, test=False):
-    """ Generate combined list by calculating aggregate scores on (potentially filtered) source lists of ranked domains """
-    db_id = _list_id_to_db_id(list_id)
+def publish_job_event(list_id, stage, completed=False, success=None):
+    """ Publish progress of list generation to subscribers (when running as an rq job) """
+    if list_id is None:
+        return
     try:
-        ### INPUT ###
-
-        # If a filter on parts is selected, the preprocessed parts files should be used.
-        parts_filter = config.get("filterPLD", False) or (config.get("filterTLD", "false") != "false") or config.get("filterOrganization", False) or config.get('filterSubdomain', False)
-        dates = date_list(config.get("startDate"), config.get("endDate"))
-
-        # Get source files to process
-        fps = []
-        fps_on_date = {date: [] for date in dates}
-        fps_on_provider = {provider: [] for provider in config['providers']}
-        for provider in config['providers']:
-            for date in dates:
-                if USE_S3:
-                    list_fp = get_s3_key_for_day(provider, date, parts_filter)
-                else:
-                    list_fp = get_list_fp_for_day(provider, date, parts_filter)
-                fps.append(list_fp)
-                fps_on_date[date].append(list_fp)
-                fps_on_provider[provider].append(list_fp)
-
-        # Get requested list prefix
-        if "listPrefix" in config and config['listPrefix']:
-            if config['listPrefix'] == "full":
-                input_prefix = None
-            elif config['listPrefix'] == "custom":
-                input_prefix = int(config['listPrefixCustomValue'])
+        from rq import get_current_job
+    except ImportError:
+        return
+    job = get_current_job()
+    if job is None:
+        return
+    try:
+        job.connection.publish(JOB_EVENTS_CHANNEL_FORMAT.format(list_id),
+                               json.dumps({"completed": completed, "success": success, "stage": stage}))
+    except:
+        traceback.print_exc()
+
+def combine_lists(config, sources=None, list_id=None):
+    """
+    Calculate aggregate scores on (potentially filtered) source lists of ranked domains, without storing the result
+    :param config: list configuration
+    :param sources: source lists for every provider and date, as {(provider, "YYYY-MM-DD"): path or rows}
+                    (parts files if a filter on parts is selected); source lists are taken from the archive if not set
+    :param list_id: ID of the list, for publishing progress of list generation
+    :return: ranked domains (iterable ranking when scoring is partitioned)
+    """
+    ### INPUT ###
+    publish_job_event(list_id, "input")
+
+    # If a filter on parts is selected, the preprocessed parts files should be used.
+    parts_filter = config.get("filterPLD", False) or (config.get("filterTLD", "false") != "false") or config.get("filterOrganization", False) or config.get('filterSubdomain', False)
+    dates = date_list(config.get("startDate"), config.get("endDate"))
+
+    # Get source files to process
+    fps = []
+    fps_on_date = {date: [] for date in dates}
+    fps_on_provider = {provider: [] for provider in config['providers']}
+    available_s3_keys = {}
+    for provider in config['providers']:
+        for date in dates:
+            if sources is not None:
+                list_fp = LocalSourceList(sources[(provider, date.strftime("%Y-%m-%d"))])
+            elif USE_S3:
+                list_fp = get_s3_key_for_day(provider, date, parts_filter, available_s3_keys)
             else:
-                input_prefix = int(config['listPrefix'])
-        else:
+                list_fp = get_list_fp_for_day(provider, date, parts_filter)
+            fps.append(list_fp)
+            fps_on_date[date].append(list_fp)
+            fps_on_provider[provider].append(list_fp)
+
+    # Get requested list prefix
+    if "listPrefix" in config and config['listPrefix']:
+        if config['listPrefix'] == "full":
             input_prefix = None
-
-        # Generate (sorted) aggregate counts (on parts files if necessary)
+        elif config['listPrefix'] == "custom":
+            input_prefix = int(config['listPrefixCustomValue'])
+        else:
+            input_prefix = int(config['listPrefix'])
+    else:
+        input_prefix = None
+
+    # Presence filters: (groups of source lists, minimum number of groups a domain should appear in)
+    presence_filters = []
+    if "inclusionDays" in config and config["inclusionDays"]:
+        presence_filters.append(([fps_on_date[date] for date in dates], int(config["inclusionDaysValue"])))
+    if "inclusionLists" in config and config["inclusionLists"]:
+        presence_filters.append(([fps_on_provider[provider] for provider in config['providers']], int(config["inclusionListsValue"])))
+
+    # Generate (sorted) aggregate counts (on parts files if necessary)
+    publish_job_event(list_id, "scoring")
+    if SCORING_PARTITIONS:
+        # Bounded memory: aggregate per hash partition, applying the presence filters per partition as well
+        sorted_domains = PartitionedRanking(score_contributions(fps, input_prefix, config, parts_filter, config['combinationMethod']),
+                                            SCORING_PARTITIONS, SCORING_PROCESSES, SCORING_PARTITIONS_PATH, SCORING_COMBINE_LISTS or 1,
+                                            [(presence_contributions(groups_of_fps, input_prefix), minimum) for groups_of_fps, minimum in presence_filters])
+    else:
         if parts_filter:
             if config['combinationMethod'] == 'borda':
                 scores = borda_count_list(fps, input_prefix, config)
@@ -501,53 +834,51 @@ def generate_combined_list(config, list_id, test=False):
             else:
                 raise Exception("Unknown combination method")
         sorted_domains = sort_counts(scores)
-        domains = sorted_domains
+    domains = sorted_domains
 
-        ### FILTERS ###
+    ### FILTERS ###
+    publish_job_event(list_id, "filters")
 
-        filters_to_apply = []
-        if "inclusionDays" in config and config["inclusionDays"]:
-            presence_filter = generate_filter_minimum_presence_any([fps_on_date[date] for date in dates], input_prefix, int(config["inclusionDaysValue"]))
-            filters_to_apply.append(presence_filter)
-        if "inclusionLists" in config and config["inclusionLists"]:
-            presence_filter = generate_filter_minimum_presence_any([fps_on_provider[provider] for provider in config['providers']], input_prefix, int(config["inclusionListsValue"]))
-            filters_to_apply.append(presence_filter)
+    if presence_filters and not SCORING_PARTITIONS:
+        # (applied per partition when scoring is partitioned)
+        filters_to_apply = [generate_filter_minimum_presence_any(groups_of_fps, input_prefix, minimum) for groups_of_fps, minimum in presence_filters]
         domains = filter_list_multiple(domains, filters_to_apply)
 
+    return domains
+
+def generate_combined_list(config, list_id, test=False):
+    """ Generate combined list by calculating aggregate scores on (potentially filtered) source lists of ranked domains """
+    db_id = None if test else _list_id_to_db_id(list_id)
+    try:
+        domains = combine_lists(config, list_id=list_id)
+
         ### OUTPUT ###
+        publish_job_event(list_id, "output")
 
         if test:
-            return domains
+            return list(domains)
         else:
-            # Write list to file
+            # Write list to file (deduplicated on contents)
             if USE_S3:
-                write_list_to_s3(domains, list_id)
+                content_hash = write_list_to_s3(domains, list_id)
             else:
-                write_list_to_file(domains, list_id)
+                content_hash = write_list_to_file(domains, list_id)
 
-            # If the list is the daily default list, also generate a zip of the top 1M and copy to permanent URL
-            try:
-                if "isDailyList" in config and config["isDailyList"] is True:
-                    if USE_S3:
-                        write_zip_to_s3(domains[:1000000], list_id)
-                        copy_daily_list_s3(list_id)
-                    else:
-                        write_zip_to_file(domains[:1000000], list_id)
-                        copy_daily_list_file(list_id)
-            except:
-                print("Zip creation failed")
-                traceback.print_exc()
+            # Compressed exports (and the zip of the daily list) are created by a separate job, see export_list.py
 
             # Update generation success in database
-            db["lists"].update_one({"_id": db_id}, {"$set": {"finished": True, "failed": False, "list_id": list_id}})
+            get_db()["lists"].update_one({"_id": db_id}, {"$set": {"finished": True, "failed": False, "list_id": list_id, "contentHash": content_hash}})
 
         time.sleep(1)
         # Report success
+        publish_job_event(list_id, "finished", completed=True, success=True)
         return True
     except:
         traceback.print_exc()
         # Update generation failure in database
-        db["lists"].update_one({"_id": db_id}, {"$set": {"finished": True, "failed": True}})
+        if not test:
+            get_db()["lists"].update_one({"_id": db_id}, {"$set": {"finished": True, "failed": True}})
         # Report failure
+        publish_job_event(list_id, "finished", completed=True, success=False)
         return False
 
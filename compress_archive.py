@@ -0,0 +1,81 @@
+import gzip
+import os
+import shutil
+import sys
+
+COMPRESSION_LEVELS = {"zst": 19, "gz": 9}
+
+
+def compress_stream(input_file, output_file, compression):
+    """ Compress binary stream into another binary stream """
+    if compression == "zst":
+        import zstandard
+        cctx = zstandard.ZstdCompressor(level=COMPRESSION_LEVELS[compression], threads=-1)
+        cctx.copy_stream(input_file, output_file)
+    elif compression == "gz":
+        with gzip.GzipFile(fileobj=output_file, mode='wb', compresslevel=COMPRESSION_LEVELS[compression]) as gzip_file:
+            shutil.copyfileobj(input_file, gzip_file)
+    else:
+        raise ValueError("Unknown compression {}".format(compression))
+
+
+def compress_file(input_fp, compression):
+    """ Compress a source list next to the original, writing to a temporary file first so readers never see partial output """
+    output_fp = "{}.{}".format(input_fp, compression)
+    tmp_fp = output_fp + ".tmp"
+    with open(input_fp, 'rb') as input_file, open(tmp_fp, 'wb') as output_file:
+        compress_stream(input_file, output_file, compression)
+    os.replace(tmp_fp, output_fp)
+    return output_fp
+
+
+def compress_archive(archive_path, compression, remove_original=False):
+    """ Recompress all raw source lists (including parts files) in the file-based archive, skipping lists compressed already """
+    for dirpath, dirnames, filenames in os.walk(archive_path):
+        for filename in sorted(filenames):
+            if not filename.endswith(".csv"):
+                continue
+            if "{}.{}".format(filename, compression) in filenames:
+                # Compressed by an earlier run (which did not remove the original)
+                if remove_original:
+                    os.remove(os.path.join(dirpath, filename))
+                continue
+            input_fp = os.path.join(dirpath, filename)
+            output_fp = compress_file(input_fp, compression)
+            print(output_fp)
+            if remove_original:
+                os.remove(input_fp)
+
+
+def compress_archive_s3(bucket_name, prefix, compression, remove_original=False):
+    """ Recompress all raw source lists (including parts files) in the S3 archive, streaming from and to S3, skipping lists compressed already """
+    import combined_lists
+    bucket = combined_lists.get_s3_resource().Bucket(bucket_name)
+    all_keys = {obj.key for obj in bucket.objects.filter(Prefix=prefix)}
+    keys = sorted(key for key in all_keys if key.endswith(".csv"))
+    for key in keys:
+        output_key = "{}.{}".format(key, compression)
+        if output_key in all_keys:
+            # Compressed by an earlier run (which did not remove the original)
+            if remove_original:
+                bucket.Object(key).delete()
+            continue
+        # The compressed object only becomes visible once the multipart upload completes
+        with combined_lists.smart_open("s3://{}/{}".format(bucket_name, key), 'rb', compression='disable') as input_file, \
+                combined_lists.smart_open("s3://{}/{}".format(bucket_name, output_key), 'wb', compression='disable') as output_file:
+            compress_stream(input_file, output_file, compression)
+        print("s3://{}/{}".format(bucket_name, output_key))
+        if remove_original:
+            bucket.Object(key).delete()
+
+
+if __name__ == '__main__':
+    # Archive is a local directory, or s3://bucket/prefix
+    archive_path = sys.argv[1]
+    compression = sys.argv[2] if len(sys.argv) > 2 else "zst"
+    remove_original = "--remove" in sys.argv[3:]
+    if archive_path.startswith("s3://"):
+        bucket_name, _, prefix = archive_path[len("s3://"):].partition("/")
+        compress_archive_s3(bucket_name, prefix, compression, remove_original)
+    else:
+        compress_archive(archive_path, compression, remove_original)
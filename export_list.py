@@ -0,0 +1,171 @@
+import collections
+import gzip
+import os
+import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+import combined_lists
+from global_config import USE_S3
+from combined_lists import smart_open
+from shared import EXPORT_FILENAME_FORMATS
+
+CHUNK_SIZE = 4 * 1024 * 1024  # Size of chunks of the list that are compressed independently
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+COMPRESSION_THREADS = 4
+
+
+def open_generated_list(list_id):
+    """ Open generated list for reading its CSV bytes """
+    if USE_S3:
+        return smart_open(combined_lists.get_generated_list_s3(list_id), 'rb', compression='disable')
+    else:
+        return open(combined_lists.get_generated_list_fp(list_id), 'rb')
+
+
+@contextmanager
+def open_replacing(fp):
+    """ Open file for writing, only replacing the destination once the file is complete """
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    tmp_fp = "{}.{}.tmp".format(fp, os.getpid())
+    try:
+        with open(tmp_fp, 'wb') as f:
+            yield f
+    except:
+        os.remove(tmp_fp)
+        raise
+    os.replace(tmp_fp, fp)  # atomic, also if an export of identical contents finishes at the same time
+
+
+def open_export(list_id, export_format):
+    """ Open destination of an export for streaming writes (exports are compressed already, whatever the extension) """
+    if USE_S3:
+        # The object only becomes visible once the multipart upload completes
+        return smart_open(combined_lists.get_generated_export_s3(list_id, export_format), 'wb', compression='disable')
+    else:
+        return open_replacing(combined_lists.get_generated_export_fp(list_id, export_format))
+
+
+def open_daily_zip(list_id):
+    """ Open destination of the zip of the daily list """
+    if USE_S3:
+        return smart_open(combined_lists.get_generated_zip_s3(list_id), 'wb', compression='disable')
+    else:
+        return open(combined_lists.get_generated_zip_fp(list_id), 'wb')
+
+
+def read_chunks(f, chunk_size=CHUNK_SIZE):
+    """ Read file in chunks of (at most) the given size """
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def map_ordered(executor, fn, iterable, max_pending):
+    """ Like executor.map, but with at most max_pending items in flight, so the input is not read all at once """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def export_gzip(source, destination):
+    """ Compress chunks into separate gzip members in parallel; concatenated members form a valid gzip file """
+    with ThreadPoolExecutor(max_workers=COMPRESSION_THREADS) as executor:
+        compress = lambda chunk: gzip.compress(chunk, compresslevel=GZIP_LEVEL)
+        for member in map_ordered(executor, compress, read_chunks(source), 2 * COMPRESSION_THREADS):
+            destination.write(member)
+
+
+def export_zstd(source, destination):
+    """ Compress with zstd, using its built-in multi-threaded compression """
+    import zstandard
+    cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=COMPRESSION_THREADS)
+    with cctx.stream_writer(destination, closefd=False) as writer:
+        for chunk in read_chunks(source):
+            writer.write(chunk)
+
+
+def export_zip(source, destination, arcname):
+    """ Compress into a (deflated) zip archive """
+    with zipfile.ZipFile(destination, 'w', compression=zipfile.ZIP_DEFLATED) as a:
+        with a.open(arcname, 'w', force_zip64=True) as entry:
+            for chunk in read_chunks(source):
+                entry.write(chunk)
+
+
+def export_parquet(source, destination):
+    """ Convert into a Parquet file with (rank, domain) columns, batch by batch """
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+    reader = pyarrow.csv.open_csv(source,
+                                  read_options=pyarrow.csv.ReadOptions(column_names=["rank", "domain"]),
+                                  convert_options=pyarrow.csv.ConvertOptions(column_types={"rank": pyarrow.int32(), "domain": pyarrow.string()}))
+    with pyarrow.parquet.ParquetWriter(destination, reader.schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+
+def export_to_format(list_id, export_format):
+    """ Export generated list to one format; exports are shared by lists with identical contents, so existing ones are kept """
+    if combined_lists.export_available(list_id, export_format):
+        return
+    with open_generated_list(list_id) as source, open_export(list_id, export_format) as destination:
+        if export_format == "zip":
+            # The entry name does not depend on the list ID, as the zip is shared by lists with identical contents
+            export_zip(source, destination, EXPORT_FILENAME_FORMATS["zip"].format("list")[:-len(".zip")])
+        elif export_format == "gzip":
+            export_gzip(source, destination)
+        elif export_format == "zstd":
+            export_zstd(source, destination)
+        elif export_format == "parquet":
+            export_parquet(source, destination)
+        else:
+            raise ValueError("Unknown export format {}".format(export_format))
+
+
+def export_daily_zip(list_id):
+    """ Write list of (top 1M) domains of the daily list to zip file and copy to permanent URL """
+    with open_generated_list(list_id) as source, open_daily_zip(list_id) as destination:
+        with zipfile.ZipFile(destination, 'w', compression=zipfile.ZIP_DEFLATED) as a:
+            with a.open("top-1m.csv", 'w') as entry:
+                entry.writelines(islice(source, 1000000))
+    if USE_S3:
+        combined_lists.copy_daily_list_s3(list_id)
+    else:
+        combined_lists.copy_daily_list_file(list_id)
+
+
+def export_generated_list(list_id, export_formats=None):
+    """
+    Export a generated list to compressed (and columnar) formats, all formats in parallel
+    :param list_id: ID of generated list
+    :param export_formats: formats to export to (all formats if not set)
+    :return: whether all exports succeeded
+    """
+    if not combined_lists.list_available(list_id):
+        return False
+    if not export_formats:
+        export_formats = list(EXPORT_FILENAME_FORMATS.keys())
+    config = combined_lists.list_id_to_config(list_id)
+    with ThreadPoolExecutor(max_workers=len(export_formats) + 1) as executor:
+        futures = {f: executor.submit(export_to_format, list_id, f) for f in export_formats}
+        # If the list is the daily default list, also generate a zip of the top 1M
+        if config.get("isDailyList", False) is True:
+            futures["daily zip"] = executor.submit(export_daily_zip, list_id)
+    success = True
+    for f, future in futures.items():
+        if future.exception() is not None:
+            print("Export to {} failed".format(f))
+            traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+            success = False
+    return success
@@ -5,6 +5,7 @@ from redis import Redis
 from rq import Queue
 
 import combined_lists
+import export_list
 from shared import DATE_FORMAT_WITH_HYPHEN, DEFAULT_TRANCO_CONFIG
 
 
@@ -39,7 +40,9 @@ def generate_todays_lists(day):
         conn = Redis('localhost', 6379)
         generate_queue = Queue('generate', connection=conn, default_timeout="1h")
         if list_id not in generate_queue.job_ids:
-            generate_queue.enqueue(combined_lists.generate_combined_list, args=(config, list_id), job_id=str(list_id), timeout="1h")
+            generate_job = generate_queue.enqueue(combined_lists.generate_combined_list, args=(config, list_id), job_id=str(list_id), timeout="1h")
+            export_queue = Queue('export', connection=conn, default_timeout="1h")
+            export_queue.enqueue(export_list.export_generated_list, list_id, depends_on=generate_job)
             print("Submitted job for list ID {}".format(list_id))
 
 
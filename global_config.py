@@ -7,4 +7,10 @@ MONGO_URL = None  # Mongo instance for storing configurations of lists
 USE_S3 = None  # Boolean indicating whether to use AWS services
 GENERATION_REMOTE = None  # Boolean indicating whether list generation is handled remotely
 GENERATION_REMOTE_ENDPOINT = None  # Endpoint accepting list generation jobs
-JOB_SERVER_PORT = None  # Port of server accepting list generation jobs
\ No newline at end of file
+JOB_SERVER_PORT = None  # Port of server accepting list generation jobs
+SCORING_PARTITIONS = None  # Number of hash partitions for aggregating scores with bounded memory (single in-memory pass if not set)
+SCORING_PROCESSES = None  # Number of processes aggregating the partitions in parallel
+SCORING_PARTITIONS_PATH = None  # Directory for partition files (default temporary directory if not set)
+SCORING_COMBINE_LISTS = None  # Number of source lists whose scores are grouped per domain before writing partitions (memory vs. disk usage)
+SOURCE_CACHE_PATH = None  # Memory-backed directory (e.g. under /dev/shm) for caching parsed source lists between jobs (no caching if not set)
+SOURCE_CACHE_BUDGET = None  # Maximum size of the source list cache (in bytes; half the size of the file system holding the cache if not set)
@@ -1,11 +1,21 @@
+import asyncio
 import functools
+import json
+import traceback
 
+import aiohttp
 from redis import Redis
+import redis.asyncio
 from rq import Queue
 from rq.registry import StartedJobRegistry
 
 import combined_lists
+import export_list
 import notify_email
+from shared import JOB_EVENTS_CHANNEL_FORMAT
+
+JOB_EVENTS_KEEPALIVE_INTERVAL = 15  # Seconds without events after which a job event stream sends a keepalive
+JOB_STATUS_REFRESH_INTERVAL = 60  # Seconds between checks of subscribed jobs for dead workers and timeouts
 
 
 class JobHandler:
@@ -15,31 +25,39 @@ class JobHandler:
     def __init__(self, asyncio_loop):
         self.loop = asyncio_loop
         self.setup_job_queues()
+        self.event_subscribers = {}  # list ID -> queues of subscribers to events of that job
+        self.event_pubsub = None
+        self.event_pubsub_lock = asyncio.Lock()
+        self.event_statuses = {}  # list ID -> last status sent to subscribers of that job
 
     def setup_job_queues(self):
         """ Setup rq queues for submitting list generation and email notification jobs. """
         self.conn = Redis('localhost', 6379)
         self.generate_queue = Queue('generate', connection=self.conn, default_timeout="1h")
         self.email_queue = Queue('notify_email', connection=self.conn)
+        self.export_queue = Queue('export', connection=self.conn, default_timeout="1h")
 
     async def submit_generate_job(self, config, list_id):
         """ Submit a new job for generating a list (with the given config) """
         if list_id not in await self.loop.run_in_executor(None, self.current_jobs):
-            await self.loop.run_in_executor(None, functools.partial(self.generate_queue.enqueue, combined_lists.generate_combined_list, args=(config, list_id), job_id=str(list_id), timeout="1h"))
+            generate_job = await self.loop.run_in_executor(None, functools.partial(self.generate_queue.enqueue, combined_lists.generate_combined_list, args=(config, list_id), job_id=str(list_id), timeout="1h"))
+            await self.loop.run_in_executor(None, functools.partial(self.export_queue.enqueue, export_list.export_generated_list, list_id, depends_on=generate_job))
             return True
         else:
             return False
 
     async def submit_email_job(self, email_address, list_id, list_size):
         """ Submit a new job for sending an email once a list has been generated """
-        generate_job = await self.loop.run_in_executor(None, self.generate_queue.fetch_job, list_id)
-        await self.loop.run_in_executor(None, functools.partial(self.email_queue.enqueue, notify_email.send_notification_mailgun_api, email_address, list_id, list_size, depends_on=generate_job))
+        # Notifications for the same list are coalesced into one job
+        if await self.loop.run_in_executor(None, notify_email.queue_notification, self.conn, email_address, list_id, list_size):
+            generate_job = await self.loop.run_in_executor(None, self.generate_queue.fetch_job, list_id)
+            await self.loop.run_in_executor(None, functools.partial(self.email_queue.enqueue, notify_email.send_batched_notifications_mailgun_api, list_id, depends_on=generate_job, retry=notify_email.NOTIFICATION_RETRY))
         return True
 
     def current_jobs(self):
         """ Track currently active and queued jobs """
         registry = StartedJobRegistry(queue=self.generate_queue)
-        jobs = registry.get_job_ids() + self.current_jobs()
+        jobs = registry.get_job_ids() + self.generate_queue.job_ids
 
         return jobs
 
@@ -53,13 +71,120 @@ class JobHandler:
 
     async def get_job_status(self, list_id):
         """ Get current status of a job """
-        job_success = await self.loop.run_in_executor(None, self.get_job_success, list_id)
+        # Jobs ahead first: listing the started jobs moves jobs of dead workers to failed
         jobs_ahead = await self.loop.run_in_executor(None, self.jobs_ahead_of_job, list_id)
+        job_success = await self.loop.run_in_executor(None, self.get_job_success, list_id)
         return {"completed": job_success is not None, "jobs_ahead": jobs_ahead, "success": job_success}
 
     def get_job_success(self, list_id):
-        """ Get current rq status of a job """
-        return self.generate_queue.fetch_job(list_id).result
+        """ Get current rq status of a job (failed without result if it timed out or its worker died) """
+        job = self.generate_queue.fetch_job(list_id)
+        if job is None:
+            # Job result expired: the stored status of the list tells whether generation succeeded
+            return combined_lists.list_available(list_id)
+        if job.is_failed:
+            return False
+        return job.result
+
+    async def subscribe_job_events(self):
+        """ Subscribe (once) to events published by all list generation jobs, and dispatch them to subscribers of each job """
+        async with self.event_pubsub_lock:
+            if self.event_pubsub is not None:
+                return
+            pubsub = redis.asyncio.Redis('localhost', 6379).pubsub()
+            await pubsub.psubscribe(JOB_EVENTS_CHANNEL_FORMAT.format("*"))
+            self.event_pubsub = pubsub
+            self.loop.create_task(self.dispatch_job_events(pubsub))
+
+    def send_job_event(self, list_id, event):
+        """ Send event to all subscribers of the job, as an update of the last status sent """
+        status = dict(self.event_statuses.get(list_id, {}), **event)
+        if status == self.event_statuses.get(list_id):
+            return
+        self.event_statuses[list_id] = status
+        for queue in self.event_subscribers.get(list_id, ()):
+            queue.put_nowait(status)
+
+    async def refresh_job_statuses(self):
+        """ Update positions of all subscribed jobs with one scan of the queue, and detect jobs that ended without an event """
+        if not self.event_subscribers:
+            return
+        # Listing the started jobs also moves jobs of dead workers to failed
+        jobs = await self.loop.run_in_executor(None, self.current_jobs)
+        positions = {job_id: idx for idx, job_id in enumerate(jobs)}
+        for list_id in list(self.event_subscribers):
+            if list_id in positions:
+                self.send_job_event(list_id, {"jobs_ahead": positions[list_id]})
+            else:
+                # Not queued or running (anymore): completed, timed out, or its worker died
+                job_success = await self.loop.run_in_executor(None, self.get_job_success, list_id)
+                self.send_job_event(list_id, {"completed": job_success is not None, "jobs_ahead": 0, "success": job_success})
+
+    async def dispatch_job_events(self, pubsub):
+        """
+        Fan out published events to all subscribers of the job, and refresh the status of all subscribed jobs when a job
+        starts or completes (i.e. the queue moves) or periodically; resubscribes if the subscription fails
+        """
+        channel_prefix = JOB_EVENTS_CHANNEL_FORMAT.format("")
+        next_refresh = self.loop.time() + JOB_STATUS_REFRESH_INTERVAL
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=max(0.0, next_refresh - self.loop.time()))
+                refresh = self.loop.time() >= next_refresh
+                if message is not None and message["type"] == "pmessage":
+                    list_id = message["channel"].decode("utf-8")[len(channel_prefix):]
+                    event = json.loads(message["data"])
+                    self.send_job_event(list_id, event)
+                    refresh = refresh or event["completed"] or event["stage"] == "input"
+                if refresh:
+                    try:
+                        await self.refresh_job_statuses()
+                    except Exception:
+                        traceback.print_exc()
+                    next_refresh = self.loop.time() + JOB_STATUS_REFRESH_INTERVAL
+        except Exception:
+            traceback.print_exc()
+        async with self.event_pubsub_lock:
+            self.event_pubsub = None
+        try:
+            await pubsub.reset()
+        except:
+            pass
+        # Events may have been missed: all subscribers refresh their status, which also subscribes again
+        for queues in self.event_subscribers.values():
+            for queue in queues:
+                queue.put_nowait(None)
+
+    async def job_events(self, list_id):
+        """
+        Stream status of a job: its current status, followed by updates until the job completes;
+        None is yielded as keepalive when there are no updates for a while
+        """
+        queue = asyncio.Queue()
+        self.event_subscribers.setdefault(list_id, set()).add(queue)
+        try:
+            # Subscribe before retrieving the current status, so that no events are missed
+            await self.subscribe_job_events()
+            status = await self.get_job_status(list_id)
+            self.event_statuses.setdefault(list_id, status)
+            yield status
+            while not status["completed"]:
+                try:
+                    event = await asyncio.wait_for(queue.get(), JOB_EVENTS_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event is None:
+                    # Subscription was lost
+                    await self.subscribe_job_events()
+                    event = await self.get_job_status(list_id)
+                status = dict(status, **event)
+                yield status
+        finally:
+            self.event_subscribers[list_id].discard(queue)
+            if not self.event_subscribers[list_id]:
+                del self.event_subscribers[list_id]
+                self.event_statuses.pop(list_id, None)
 
 
 class JobHandlerRemote:
@@ -96,6 +221,16 @@ class JobHandlerRemote:
             jsn = await response.json()
             return jsn
 
+    async def job_events(self, list_id):
+        """ Stream status of a job, as server-sent events from the remote machine (None for keepalives) """
+        async with self.session.get("{}/job_events".format(self.endpoint), params={"list_id": list_id}, timeout=aiohttp.ClientTimeout(total=None, sock_read=4 * JOB_EVENTS_KEEPALIVE_INTERVAL)) as response:
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    yield json.loads(line[len("data:"):])
+                elif line.startswith(":"):
+                    yield None
+
     async def retrieve_list(self, list_id, slice_size):
         """ Retrieve the contents of a remotely generated list """
         async with self.session.get("{}/retrieve_list".format(self.endpoint), json={"list_id": list_id, "slice_size": slice_size}) as response:
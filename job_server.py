@@ -1,4 +1,6 @@
 import asyncio
+import json
+
 import aitertools
 from aiohttp import web
 
@@ -37,6 +39,19 @@ class JobServer:
         print("Getting status for ", list_id)
         return web.json_response(await self.job_handler.get_job_status(list_id))
 
+    async def job_events(self, request):
+        """ Stream status of a job as server-sent events, until the job completes """
+        list_id = request.query['list_id']
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        async for event in self.job_handler.job_events(list_id):
+            if event is None:
+                await response.write(b": ping\n\n")  # keepalive (comment line)
+            else:
+                await response.write("data: {}\n\n".format(json.dumps(event)).encode("utf-8"))
+        await response.write_eof()
+        return response
+
     async def retrieve_list(self, request):
         """ Retrieve the contents of a remotely generated list """
         post_data = await request.json()
@@ -59,6 +74,7 @@ class JobServer:
             web.post('/submit_generate', self.submit_generate_job),
             web.post('/submit_email', self.submit_email_job),
             web.get('/job_status', self.get_job_status),
+            web.get('/job_events', self.job_events),
             web.get('/retrieve_list', self.retrieve_list)
         ])
 
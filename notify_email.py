@@ -1,29 +1,148 @@
+import json
 import smtplib
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 import email.utils
 
 import requests
-from rq import Queue, Connection, get_current_connection
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry as HTTPRetry
+from rq import Queue, Connection, Retry, get_current_connection
 from global_config import MAILGUN_API_KEY
+import combined_lists
 
-def send_notification_mailgun_api(email_address, list_id, list_size):
-    with Connection(get_current_connection()):
-        q = Queue('generate')
-        job = q.fetch_job(list_id)
-        success = job.result
+MAILGUN_API_ENDPOINT = "https://api.eu.mailgun.net/v3/mg.tranco-list.eu/messages"
+MAILGUN_BATCH_SIZE = 1000  # Maximum number of recipients of one Mailgun batch message
+MAX_CONCURRENT_REQUESTS = 8
+PENDING_NOTIFICATIONS_KEY = "notify_email:pending:{}"  # Redis list of recipients waiting for a list
+NOTIFICATION_JOB_KEY = "notify_email:job:{}"  # Set while a notification job for a list is queued
+NOTIFICATION_JOB_KEY_TTL = 86400
+NOTIFICATION_RETRY = Retry(max=3, interval=[60, 600, 3600])  # Retry failed sends later (scheduled retries require workers started with --with-scheduler)
 
+
+def notification_message(success, list_id, list_size):
+    """ Subject and body of notification email """
     if success:
         subject = 'The Tranco list: generation succeeded'
         body = "Hello,\n\nWe have successfully generated your requested Tranco list with ID {}. You may retrieve it at https://tranco-list.eu/list/{}/{}\n\nTranco\nhttps://tranco-list.eu/".format(list_id, list_id, list_size)
     else:
         subject = 'The Tranco list: generation failed'
         body = "Hello,\n\nUnfortunately, we were currently unable to generate your requested Tranco list with ID {}. Please try again later.\n\nTranco\nhttps://tranco-list.eu/".format(list_id)
+    return subject, body
+
+
+def get_generate_job_success(list_id):
+    """ Whether list generation succeeded; the stored status of the list is used if the generate job has expired """
+    with Connection(get_current_connection()):
+        q = Queue('generate')
+        job = q.fetch_job(list_id)
+    if job is None:
+        return combined_lists.list_available(list_id)
+    return job.result
+
+
+def send_notification_mailgun_api(email_address, list_id, list_size):
+    success = get_generate_job_success(list_id)
+    subject, body = notification_message(success, list_id, list_size)
 
     r = requests.post(
-            "https://api.eu.mailgun.net/v3/mg.tranco-list.eu/messages",
+            MAILGUN_API_ENDPOINT,
             auth=("api", MAILGUN_API_KEY),
             data={"from": "Tranco <noreply@mg.tranco-list.eu>",
                   "to": [email_address],
                   "subject": subject,
                   "text": body})
-    return int(r.status_code) == 200
\ No newline at end of file
+    return int(r.status_code) == 200
+
+
+def queue_notification(conn, email_address, list_id, list_size):
+    """
+    Add recipient to the pending notifications for a list
+    :return: whether a new notification job should be submitted for the list (i.e. none is queued yet)
+    """
+    conn.rpush(PENDING_NOTIFICATIONS_KEY.format(list_id), json.dumps([email_address, list_size]))
+    return bool(conn.set(NOTIFICATION_JOB_KEY.format(list_id), 1, nx=True, ex=NOTIFICATION_JOB_KEY_TTL))
+
+
+def take_pending_notifications(conn, list_id):
+    """ Atomically retrieve and remove all pending recipients for a list """
+    # Release the job key first: recipients added from now on either end up in this batch or submit a new job
+    conn.delete(NOTIFICATION_JOB_KEY.format(list_id))
+    pipe = conn.pipeline()
+    pipe.lrange(PENDING_NOTIFICATIONS_KEY.format(list_id), 0, -1)
+    pipe.delete(PENDING_NOTIFICATIONS_KEY.format(list_id))
+    pending, _ = pipe.execute()
+    return [json.loads(p) for p in pending]
+
+
+def restore_pending_notifications(conn, list_id, batches):
+    """ Put recipients of batches that could not be sent back into the pending notifications for a list """
+    pipe = conn.pipeline()
+    for batch in batches:
+        for email_address, recipient_variables in batch.items():
+            pipe.rpush(PENDING_NOTIFICATIONS_KEY.format(list_id), json.dumps([email_address, recipient_variables["list_size"]]))
+    pipe.execute()
+
+
+def recipient_batches(recipients, batch_size=MAILGUN_BATCH_SIZE):
+    """ Split recipients into batches of recipient variables, where every email address appears at most once per batch """
+    batches = []
+    for email_address, list_size in dict.fromkeys(map(tuple, recipients)):
+        batch = next((b for b in batches if email_address not in b and len(b) < batch_size), None)
+        if batch is None:
+            batch = {}
+            batches.append(batch)
+        batch[email_address] = {"list_size": list_size}
+    return batches
+
+
+def mailgun_session(max_concurrent_requests=MAX_CONCURRENT_REQUESTS):
+    """ Pooled session for the Mailgun API, retrying failed requests """
+    session = requests.Session()
+    retries = HTTPRetry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"])
+    session.mount("https://", HTTPAdapter(pool_maxsize=max_concurrent_requests, max_retries=retries))
+    session.mount("http://", HTTPAdapter(pool_maxsize=max_concurrent_requests, max_retries=retries))
+    session.auth = ("api", MAILGUN_API_KEY)
+    return session
+
+
+def send_batched_notifications_mailgun_api(list_id, endpoint=MAILGUN_API_ENDPOINT):
+    """ Notify all pending recipients for a list, using Mailgun batch sending with concurrent requests """
+    conn = get_current_connection()
+    # Look up the result and set up the session before taking the recipients, so they remain pending if this fails
+    success = get_generate_job_success(list_id)
+    session = mailgun_session()
+    recipients = take_pending_notifications(conn, list_id)
+    if not recipients:
+        session.close()
+        return True
+    subject, body = notification_message(success, list_id, "%recipient.list_size%")
+
+    def send_batch(session, batch):
+        try:
+            r = session.post(
+                    endpoint,
+                    data={"from": "Tranco <noreply@mg.tranco-list.eu>",
+                          "to": list(batch.keys()),
+                          "recipient-variables": json.dumps(batch),
+                          "subject": subject,
+                          "text": body})
+        except requests.RequestException:
+            return False
+        return int(r.status_code) == 200
+
+    batches = recipient_batches(recipients)
+    try:
+        with session:
+            with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                results = list(executor.map(lambda batch: send_batch(session, batch), batches))
+    except:
+        # Recipients have been taken already: put them all back for the retry of this job
+        restore_pending_notifications(conn, list_id, batches)
+        raise
+    failed_batches = [batch for batch, result in zip(batches, results) if not result]
+    if failed_batches:
+        # Failing the job makes rq retry it (NOTIFICATION_RETRY), which picks up the restored recipients
+        restore_pending_notifications(conn, list_id, failed_batches)
+        raise Exception("Sending {} of {} notification batches for list {} failed".format(len(failed_batches), len(batches), list_id))
+    return True
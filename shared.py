@@ -6,4 +6,10 @@ DEFAULT_TRANCO_CONFIG = {"nbDays": "30", "nbDaysFrom": "end",
                   "filterPLD": "on",
                   "providers": ["alexa", "umbrella", "majestic", "quantcast"]
         }
-ZIP_FILENAME_FORMAT = "tranco_{}-1m.csv.zip"
\ No newline at end of file
+ZIP_FILENAME_FORMAT = "tranco_{}-1m.csv.zip"
+EXPORT_FILENAME_FORMATS = {"zip": "tranco_{}.csv.zip",
+                           "gzip": "tranco_{}.csv.gz",
+                           "zstd": "tranco_{}.csv.zst",
+                           "parquet": "tranco_{}.parquet"
+        }
+JOB_EVENTS_CHANNEL_FORMAT = "job_events:{}"  # Redis pub/sub channel with progress of list generation
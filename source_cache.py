@@ -0,0 +1,150 @@
+import array
+import collections.abc
+import hashlib
+import itertools
+import mmap
+import os
+import shutil
+import struct
+
+HEADER_FORMAT = "<QQ"  # number of items, number of text columns
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FORMAT_VERSION = 3  # part of the cache key, so lists cached in an older layout are never read
+
+
+class CachedSourceList(collections.abc.Sequence):
+    """
+    Items (rank, followed by text columns: the domain, or all columns of parts files) of a cached list, read directly
+    from the memory-mapped cache file instead of copied into the process; slices are views on the same mapping.
+    """
+    def __init__(self, mm, start=0, stop=None):
+        nb_items, nb_columns = struct.unpack_from(HEADER_FORMAT, mm)
+        view = memoryview(mm)
+        # Layout: header, offsets (int64, nb_items + 1) per text column, ranks (int32, nb_items), UTF-8 text of all columns
+        offsets_end = HEADER_SIZE + 8 * nb_columns * (nb_items + 1)
+        ranks_end = offsets_end + 4 * nb_items
+        offsets = view[HEADER_SIZE:offsets_end].cast('q')
+        self.columns = [offsets[c * (nb_items + 1):(c + 1) * (nb_items + 1)] for c in range(nb_columns)]
+        self.ranks = view[offsets_end:ranks_end].cast('i')
+        self.text = view[ranks_end:]
+        self.mm = mm
+        self.start = start
+        self.stop = nb_items if stop is None else min(stop, nb_items)
+
+    def __len__(self):
+        return max(0, self.stop - self.start)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return CachedSourceList(self.mm, self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("cached list index out of range")
+        i = self.start + index
+        return (str(self.ranks[i]), *[str(self.text[offsets[i]:offsets[i + 1]], "utf8") for offsets in self.columns])
+
+    def __iter__(self):
+        # Ranks are returned as text, like items read from source lists
+        ranks, text = self.ranks, self.text
+        if len(self.columns) == 1:
+            offsets = self.columns[0]
+            for i in range(self.start, self.stop):
+                yield str(ranks[i]), str(text[offsets[i]:offsets[i + 1]], "utf8")
+        else:
+            for i in range(self.start, self.stop):
+                yield (str(ranks[i]), *[str(text[offsets[i]:offsets[i + 1]], "utf8") for offsets in self.columns])
+
+
+class SourceListCache:
+    """
+    Cache of parsed source lists, shared between worker processes on the same machine.
+    Every list is stored in compact form (arrays of ranks and text offsets, and the concatenated text of the domains
+    or parts columns) in its own file in a memory-backed directory (e.g. /dev/shm), which processes mmap and read directly instead of reading and
+    parsing the source list. The total size of the cache is bounded by a budget, evicting the least recently used lists
+    first.
+    """
+    def __init__(self, path, budget=None):
+        """
+
+        :param path: directory holding the cached lists (should be memory-backed, e.g. under /dev/shm)
+        :param budget: maximum total size of cached lists (in bytes); half the size of the file system holding the cache
+                       if not set
+        """
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.budget = budget if budget else shutil.disk_usage(self.path).total // 2
+
+    def entry_fp(self, fp, list_prefix):
+        """ Location of cached list for the given source list and prefix """
+        key = "{}:{}:{}".format(FORMAT_VERSION, fp, list_prefix if list_prefix else "full")
+        return os.path.join(self.path, "{}.bin".format(hashlib.sha1(key.encode("utf8")).hexdigest()))
+
+    def get(self, fp, list_prefix):
+        """ Get cached items of source list, or None if not cached; the full list can serve any prefix """
+        items = self.load(self.entry_fp(fp, list_prefix))
+        if items is None and list_prefix:
+            items = self.load(self.entry_fp(fp, None))
+            if items is not None:
+                items = items[:list_prefix]
+        return items
+
+    def load(self, entry_fp):
+        """ Map cached list as (rank, domain) items """
+        try:
+            with open(entry_fp, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # stays valid after the file is evicted
+            os.utime(entry_fp)  # mark as recently used
+        except (FileNotFoundError, ValueError):
+            # Not cached, or evicted by another process in the meantime
+            return None
+        return CachedSourceList(mm)
+
+    def put(self, fp, list_prefix, items):
+        """ Store items (rank, followed by text columns) of source list, then evict least recently used lists beyond the budget """
+        nb_columns = len(items[0]) - 1 if items else 1
+        ranks = array.array('i', (int(item[0]) for item in items))
+        offsets = array.array('q')
+        text_length = 0
+        encoded_columns = []
+        for column in range(1, nb_columns + 1):
+            encoded = [item[column].encode("utf8") for item in items]
+            offsets.extend(itertools.accumulate(map(len, encoded), initial=text_length))
+            text_length = offsets[-1]
+            encoded_columns.append(encoded)
+        if HEADER_SIZE + len(offsets) * offsets.itemsize + len(ranks) * ranks.itemsize + text_length > self.budget:
+            return
+        entry_fp = self.entry_fp(fp, list_prefix)
+        tmp_fp = "{}.{}.tmp".format(entry_fp, os.getpid())
+        with open(tmp_fp, 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, len(ranks), nb_columns))
+            f.write(offsets.tobytes())
+            f.write(ranks.tobytes())
+            for encoded in encoded_columns:
+                f.writelines(encoded)
+        os.replace(tmp_fp, entry_fp)  # atomic, so other processes never see a partial list
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used lists until the cache fits the budget """
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".bin"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_fp in sorted(entries):
+            if total_size <= self.budget:
+                break
+            try:
+                os.remove(entry_fp)  # processes that have the list mapped keep reading it safely
+            except FileNotFoundError:
+                pass
+            total_size -= size
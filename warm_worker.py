@@ -0,0 +1,19 @@
+import sys
+
+from redis import Redis
+from rq import Queue, SimpleWorker
+
+# Imported once: connections and the source list cache stay warm across jobs
+import combined_lists
+
+
+def run_warm_worker(queue_names):
+    """ Run jobs in this (long-lived) process, instead of forking a new work horse for every job """
+    conn = Redis('localhost', 6379)
+    queues = [Queue(name, connection=conn) for name in queue_names]
+    SimpleWorker(queues, connection=conn).work()
+
+
+if __name__ == '__main__':
+    queue_names = sys.argv[1:] if len(sys.argv) > 1 else ['generate']
+    run_warm_worker(queue_names)